@@ -9,7 +9,8 @@
 # Click a bunch of places in the app before running this
 # script if you modified the calibration algorithm. Doing this will
 # verify the calibrated dataset stored against the on-the-fly
-# calibration.
+# calibration. The check is off by default, so first set
+# api.check_calibration to true in config/config.yaml and restart the API.
 #
 
 if [ -z "$1" -o -n "$2" ]; then
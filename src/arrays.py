@@ -16,8 +16,7 @@ def assert_fill_value(data_arr):
     the fill value is in exactly the masked elements.
     '''
     if not isinstance(data_arr, np.ma.masked_array) \
-    or np.any(data_arr.fill_value != data_arr[data_arr.mask]) \
-    or np.any(data_arr.fill_value == data_arr[~data_arr.mask]):
+    or np.any((data_arr.data == data_arr.fill_value) & ~np.ma.getmaskarray(data_arr)):
         raise Exception('Expected masked array with fill value in and only in the masked portion')
 
 def is_increasing(arr):
@@ -67,21 +66,84 @@ def find_coordinate_index(coord_arr, coord_delta, coord):
     Note that the coordinate may not actually be a value in the array,
     but we will return the index whose value is closest to the specified
     coordinate.
+
+    The coordinates are usually evenly spaced, so we first compute the index
+    from the first coordinate and the delta, and only check it against the
+    neighbouring coordinates. If that fails, e.g. for an irregular grid,
+    we binary search the array and check the two nearest coordinates.
     '''
-    left_axis_limit = coord_arr[0] - coord_delta
-    right_axis_limit = coord_arr[-1] + coord_delta
+    i = int(np.floor((coord - coord_arr[0]) / coord_delta + 0.5))
 
-    coord_arr = np.append(np.append(left_axis_limit, coord_arr), right_axis_limit)
+    if is_coordinate_index(coord_arr, coord_delta, coord, i):
+        return i
 
     if coord_delta > 0:
-        i = np.where(((coord_arr[:-2] + coord_arr[1:-1]) / 2 <= coord) & (coord < (coord_arr[1:-1] + coord_arr[2:]) / 2))[0]
+        j = int(np.searchsorted(coord_arr, coord))
+    else:
+        j = coord_arr.size - int(np.searchsorted(coord_arr[::-1], coord))
+
+    for i in (j - 1, j):
+        if is_coordinate_index(coord_arr, coord_delta, coord, i):
+            return i
+
+    raise Exception('Coordinate %g is out the range' % coord)
+
+def is_coordinate_index(coord_arr, coord_delta, coord, i):
+    '''
+    Checks whether the coordinate is closest to the coordinate at index i,
+    i.e. whether it lies between the midpoints with its neighbours.
+    Beyond either end of the array, the neighbour is one delta away.
+    '''
+    if not 0 <= i < coord_arr.size:
+        return False
+
+    previous_coord = coord_arr[i - 1] if i > 0 else coord_arr[0] - coord_delta
+    next_coord = coord_arr[i + 1] if i < coord_arr.size - 1 else coord_arr[-1] + coord_delta
+
+    if coord_delta > 0:
+        return (previous_coord + coord_arr[i]) / 2 <= coord < (coord_arr[i] + next_coord) / 2
+    else:
+        return (previous_coord + coord_arr[i]) / 2 > coord >= (coord_arr[i] + next_coord) / 2
+
+def find_lat_indices(lat_arr, lat_delta, lats):
+    '''
+    Finds the indices of the specified latitudes in the latitude array.
+    '''
+    return find_coordinate_indices(lat_arr, lat_delta, lats)
+
+def find_lon_indices(lon_arr, lon_delta, lons):
+    '''
+    Finds the indices of the specified longitudes in the longitude array.
+    '''
+    # Same as in find_lon_index(), longitudes beyond the last data point
+    # resolve to the other side of the antimeridian.
+    if lon_delta > 0:
+        lons = np.where(lons >= lon_arr[-1] + lon_delta / 2, lons - 360, lons)
     else:
-        i = np.where(((coord_arr[:-2] + coord_arr[1:-1]) / 2 > coord) & (coord >= (coord_arr[1:-1] + coord_arr[2:]) / 2))[0]
+        raise Exception('Unsupported: decreasing longitudes in dataset')
+
+    return find_coordinate_indices(lon_arr, lon_delta, lons)
 
-    if len(i) == 0:
-        raise Exception('Coordinate %g is out the range' % coord)
+def find_coordinate_indices(coord_arr, coord_delta, coords):
+    '''
+    Finds the indices of the coordinates in the coordinate array.
+    This does the same as find_coordinate_index() but for a whole
+    array of coordinates at once.
+
+    Returns the indices together with a boolean array telling which
+    coordinates are within the range. The indices of coordinates out of
+    the range are still valid indices, but should not be used.
+    '''
+    midpoints = (coord_arr[:-1] + coord_arr[1:]) / 2
+
+    if coord_delta > 0:
+        indices = np.searchsorted(midpoints, coords, side='right')
+        in_range = (coord_arr[0] - coord_delta / 2 <= coords) & (coords < coord_arr[-1] + coord_delta / 2)
+    else:
+        indices = np.searchsorted(-midpoints, -coords, side='left')
+        in_range = (coord_arr[0] - coord_delta / 2 > coords) & (coords >= coord_arr[-1] + coord_delta / 2)
 
-    return i[0]
+    return indices, in_range
 
 def axis_limit_arrays(axis_arr, axis_delta):
     '''
@@ -56,6 +56,7 @@ def calibrate(
         calibrated=False
     )
     historical_lat, historical_lon, historical_data = climatedb.fetch_normals_from_dataset(historical_dataset, month)
+    historical_data = historical_data.astype(climatedb.FETCH_DTYPE)
 
     print('And projection dataset %s-%d-%d-%s-%s' % (
         projection_data_source_code,
@@ -73,14 +74,15 @@ def calibrate(
         calibrated=False
     )
     projection_lat, projection_lon, projection_data = climatedb.fetch_normals_from_dataset(projection_dataset, month)
+    projection_data = projection_data.astype(climatedb.FETCH_DTYPE)
 
     if projection_data.shape != historical_data.shape:
         raise Exception('Expected historical data to have the same shape as projection')
 
-    if np.any(projection_lat != historical_lat):
+    if not np.array_equal(projection_lat, historical_lat):
         raise Exception('Expected historical latitudes to be the same as projection latitudes')
 
-    if np.any(projection_lon != historical_lon):
+    if not np.array_equal(projection_lon, historical_lon):
         raise Exception('Expected historical longitudes to be the same as projection longitudes')
 
     if measurement in ABSOLUTE_DIFFERENCE_MEASUREMENTS:
@@ -107,6 +109,7 @@ def calibrate(
         calibrated=False
     )
     baseline_lat, baseline_lon, baseline_data = climatedb.fetch_normals_from_dataset(baseline_dataset, month)
+    baseline_data = baseline_data.astype(climatedb.FETCH_DTYPE)
 
     downscaled_differences = arrays.downscale_array(
         baseline_lat,
@@ -161,14 +164,32 @@ def calibrate(
         units
     ))
 
-def calibrate_location(dataset, lat, lon):
+def fetch_calibration_data_sources(data_source_id):
     '''
-    Calibrates the climate normals at a specific location
-    against historical data.
+    Fetches the baseline and historical data source IDs and the baseline
+    date range needed to calibrate the datasets of the specified data source.
+    These are the same for all of the data source's datasets.
     '''
-    measurement = climatedb.fetch_measurement_by_id(dataset['measurement_id'])['code']
     baseline_data_source_id = climatedb.fetch_baseline_data_source()
-    baseline_start_date, baseline_end_date = list(climatedb.fetch_date_ranges_by_data_source_id(baseline_data_source_id))[0]
+    baseline_start_date, baseline_end_date = climatedb.fetch_date_ranges_by_data_source_id(baseline_data_source_id)[0]
+    historical_data_source_id = climatedb.fetch_historical_data_source(data_source_id)
+
+    return baseline_data_source_id, historical_data_source_id, baseline_start_date, baseline_end_date
+
+def fetch_calibration_datasets(dataset, calibration_data_sources=None):
+    '''
+    Fetches the measurement code together with the baseline, historical,
+    and projection datasets needed to calibrate the specified dataset.
+
+    The calibration data sources can be passed in if they were already
+    fetched using fetch_calibration_data_sources().
+    '''
+    if calibration_data_sources is None:
+        calibration_data_sources = fetch_calibration_data_sources(dataset['data_source_id'])
+
+    baseline_data_source_id, historical_data_source_id, baseline_start_date, baseline_end_date = calibration_data_sources
+
+    measurement = climatedb.fetch_measurement_by_id(dataset['measurement_id'])['code']
     baseline_dataset = climatedb.fetch_dataset(
         baseline_data_source_id,
         dataset['measurement_id'],
@@ -178,7 +199,6 @@ def calibrate_location(dataset, lat, lon):
         calibrated=False
     )
 
-    historical_data_source_id = climatedb.fetch_historical_data_source(dataset['data_source_id'])
     historical_dataset = climatedb.fetch_dataset(
         historical_data_source_id,
         dataset['measurement_id'],
@@ -197,10 +217,73 @@ def calibrate_location(dataset, lat, lon):
         calibrated=False
     )
 
+    return measurement, baseline_dataset, historical_dataset, projection_dataset
+
+def calibrate_location(dataset, lat, lon, calibration_datasets=None):
+    '''
+    Calibrates the climate normals at a specific location
+    against historical data.
+
+    The calibration datasets can be passed in if they were already fetched
+    using fetch_calibration_datasets(), in which case the database is not used.
+    '''
+    if calibration_datasets is None:
+        calibration_datasets = fetch_calibration_datasets(dataset)
+
+    measurement, baseline_dataset, historical_dataset, projection_dataset = calibration_datasets
+
     actual_lat, actual_lon, historical_normals_arr = climatedb.fetch_monthly_normals(historical_dataset, lat, lon)
     actual_lat, actual_lon, projection_normals_arr = climatedb.fetch_monthly_normals(projection_dataset, lat, lon)
     actual_lat, actual_lon, baseline_normals_arr = climatedb.fetch_monthly_normals(baseline_dataset, lat, lon)
 
+    normals_arr = calibrate_normals(measurement, baseline_normals_arr, historical_normals_arr, projection_normals_arr)
+
+    return actual_lat, actual_lon, normals_arr
+
+def calibrate_locations(dataset, lats, lons, calibration_datasets=None):
+    '''
+    Calibrates the climate normals at each of the specified locations
+    against historical data. The latitudes and longitudes are numpy arrays.
+
+    Gives the actual latitudes and longitudes, and a masked array with the
+    calibrated normals of each location in a row. Locations missing data
+    in any of the datasets are masked.
+    '''
+    if calibration_datasets is None:
+        calibration_datasets = fetch_calibration_datasets(dataset)
+
+    measurement, baseline_dataset, historical_dataset, projection_dataset = calibration_datasets
+
+    actual_lats, actual_lons, historical_normals_arr = climatedb.fetch_monthly_normals_batch(historical_dataset, lats, lons)
+    actual_lats, actual_lons, projection_normals_arr = climatedb.fetch_monthly_normals_batch(projection_dataset, lats, lons)
+    actual_lats, actual_lons, baseline_normals_arr = climatedb.fetch_monthly_normals_batch(baseline_dataset, lats, lons)
+
+    # Calibrate the unmasked data. Masked arrays would mask a division by
+    # zero instead of giving infinity or NaN, so the absolute differences
+    # would never be used for months where the historical normal is zero.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normals_arr = calibrate_normals(
+            measurement,
+            np.ma.getdata(baseline_normals_arr).astype(climatedb.FETCH_DTYPE),
+            np.ma.getdata(historical_normals_arr).astype(climatedb.FETCH_DTYPE),
+            np.ma.getdata(projection_normals_arr).astype(climatedb.FETCH_DTYPE)
+        )
+
+    missing_data = (
+        np.ma.getmaskarray(historical_normals_arr).any(axis=1)
+        | np.ma.getmaskarray(projection_normals_arr).any(axis=1)
+        | np.ma.getmaskarray(baseline_normals_arr).any(axis=1)
+    )
+    normals_arr = np.ma.masked_array(normals_arr)
+    normals_arr[missing_data] = np.ma.masked
+
+    return actual_lats, actual_lons, normals_arr
+
+def calibrate_normals(measurement, baseline_normals_arr, historical_normals_arr, projection_normals_arr):
+    '''
+    Adds the projected differences to the baseline normals. The arrays
+    can be the normals of one location or have a row for each location.
+    '''
     if measurement in ABSOLUTE_DIFFERENCE_MEASUREMENTS:
         normals_arr = baseline_normals_arr + projection_normals_arr - historical_normals_arr
     else:
@@ -211,7 +294,7 @@ def calibrate_location(dataset, lat, lon):
         above_threshold = above_absolute_threshold(normals_arr, relative_differences, absolute_differences)
         normals_arr[above_threshold] = baseline_normals_arr[above_threshold] + absolute_differences[above_threshold]
 
-    return actual_lat, actual_lon, normals_arr
+    return normals_arr
 
 def above_absolute_threshold(calibrated_normals, relative_differences, absolute_differences):
     '''
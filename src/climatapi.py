@@ -5,20 +5,43 @@
 # Copyright (c) 2020 Carlos Torchia
 #
 
+import os
+
+# The arrays we work with are small, and uWSGI already runs a process per core,
+# so numpy should not start its own threads. This must be set before importing numpy.
+for num_threads_variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+    os.environ.setdefault(num_threads_variable, '1')
+
 from datetime import date
+import functools
 import numpy as np
 from flask import Flask
+from flask import Response
 from flask import jsonify
 from flask import request
 from werkzeug.routing import FloatConverter as BaseFloatConverter
 
+import config
 import climatedb
 import geonamedb
 import pack
 import calibration
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 app = Flask(__name__)
 
+# Number of search results remembered by each process.
+SEARCH_CACHE_SIZE = 10000
+
+# Date ranges and data sources only change when datasets are added,
+# so their responses are cached, and browsers may cache them for this long.
+STATIC_CACHE_SIZE = 256
+STATIC_MAX_AGE = 3600
+
 class FloatConverter(BaseFloatConverter):
     '''
     Float type in router doesn't support negative floats.
@@ -32,15 +55,17 @@ app.url_map.converters['float'] = FloatConverter
 def before():
     '''
     Connects to the database in preparation for the request.
+    The connection is kept open between requests.
     '''
-    climatedb.connect()
+    climatedb.ensure_connected()
 
 @app.teardown_request
 def teardown(error):
     '''
-    Close the database when the request finishes.
+    End the transaction when the request finishes, so that
+    the next request does not read from a stale snapshot.
     '''
-    climatedb.close()
+    climatedb.rollback()
 
 @app.route('/monthly-normals/<string:data_source>/<int:start_year>-<int:end_year>/<float:lat>/<float:lon>')
 def monthly_normals(data_source, start_year, end_year, lat, lon):
@@ -61,15 +86,31 @@ def monthly_normals(data_source, start_year, end_year, lat, lon):
 
         datasets = climatedb.fetch_datasets(data_source_id, start_date, end_date, calibrated)
 
+        # The calibration data sources are the same for every dataset.
+        if calibrated:
+            calibration_data_sources = calibration.fetch_calibration_data_sources(data_source_id)
+        else:
+            calibration_data_sources = None
+
         normals = {}
 
         for dataset in datasets:
             measurement = climatedb.fetch_measurement_by_id(dataset['measurement_id'])['code']
             units = climatedb.fetch_unit_by_id(dataset['unit_id'])['code']
 
-            actual_lat, actual_lon, normals_arr = fetch_normals_by_location(dataset, lat, lon)
+            if dataset['calibrated']:
+                calibration_datasets = calibration.fetch_calibration_datasets(dataset, calibration_data_sources)
+            else:
+                calibration_datasets = None
+
+            actual_lat, actual_lon, normals_arr = fetch_normals_by_location(
+                dataset,
+                lat,
+                lon,
+                calibration_datasets=calibration_datasets
+            )
 
-            normals[measurement] = {(m + 1): [value.item(), units] for m, value in enumerate(normals_arr)}
+            normals[measurement] = {(m + 1): [value, units] for m, value in enumerate(normals_arr.tolist())}
 
         normals.update({
             'lat': actual_lat,
@@ -77,7 +118,7 @@ def monthly_normals(data_source, start_year, end_year, lat, lon):
             'elevation': fetch_nontemporal_value('elevation', lat, lon),
         })
 
-        return jsonify(normals)
+        return json_response(normals)
 
     except climatedb.NotFoundError as e:
         return jsonify({'error': str(e)}), 404
@@ -87,13 +128,33 @@ def date_ranges():
     '''
     Gives all available date ranges for which data exist.
     '''
-    return jsonify(list(climatedb.fetch_date_ranges()))
+    return static_json_response(fetch_date_ranges_json())
+
+@functools.lru_cache(maxsize=1)
+def fetch_date_ranges_json():
+    '''
+    Gives the JSON of all available date ranges.
+    '''
+    return jsonify(climatedb.fetch_date_ranges()).get_data()
 
 @app.route('/data-sources/<int:start_year>-<int:end_year>/<string:measurement>')
 def data_sources_by_date_range(start_year, end_year, measurement):
     '''
     Gives all data-sources for the specified date range and measurement.
     '''
+    data = fetch_data_sources_json(start_year, end_year, measurement)
+
+    if data is not None:
+        return static_json_response(data)
+    else:
+        return jsonify({'error': 'Could not find date range %d-%d in the datasets' % (start_year, end_year)}), 404
+
+@functools.lru_cache(maxsize=STATIC_CACHE_SIZE)
+def fetch_data_sources_json(start_year, end_year, measurement):
+    '''
+    Gives the JSON of all data-sources for the specified date range
+    and measurement, or None if there are no datasets in the date range.
+    '''
     start_date = date(start_year, 1, 1)
     end_date = date(end_year, 12, 31)
     measurement_id = climatedb.fetch_measurement(measurement)['id']
@@ -116,10 +177,22 @@ def data_sources_by_date_range(start_year, end_year, measurement):
         ]
         selected_data_sources.sort(key=lambda data_source_record: data_source_record['name'])
 
-        return jsonify(selected_data_sources)
+        return jsonify(selected_data_sources).get_data()
 
     else:
-        return jsonify({'error': 'Could not find date range %d-%d in the datasets' % (start_year, end_year)}), 404
+        return None
+
+def static_json_response(data):
+    '''
+    Gives a response with the specified JSON that browsers may cache.
+    If the browser already has the same JSON, we just say it's not modified.
+    '''
+    response = Response(data, mimetype='application/json')
+    response.add_etag()
+    response.cache_control.public = True
+    response.cache_control.max_age = STATIC_MAX_AGE
+
+    return response.make_conditional(request)
 
 @app.route('/search/<string:query>')
 def search(query):
@@ -127,14 +200,26 @@ def search(query):
     Searches for the place specified in the query.
     '''
     try:
-        geoname = geonamedb.search_geoname(query)
+        geoname = search_place(' '.join(query.split()))
     except climatedb.NotFoundError:
         return jsonify({'error': 'Search found no results for "%s"' % query}), 404
 
+    return jsonify(geoname)
+
+@functools.lru_cache(maxsize=SEARCH_CACHE_SIZE)
+def search_place(query):
+    '''
+    Searches for the place specified in the query, together with its
+    human readable province and country. Results are cached since
+    the same places tend to be searched for over and over again.
+    Places that are not found are not cached.
+    '''
+    geoname = geonamedb.search_geoname(query)
+
     geoname['province'] = geonamedb.get_human_readable_province(geoname)
     geoname['country'] = geonamedb.get_human_readable_country(geoname)
 
-    return jsonify(geoname)
+    return geoname
 
 @app.route('/places/<string:data_source>/<int:start_year>-<int:end_year>/<string:measurement>-<string:period>')
 def climates_of_places(data_source, start_year, end_year, measurement, period):
@@ -178,36 +263,58 @@ def climates_of_places(data_source, start_year, end_year, measurement, period):
         else:
             calibrated = True
 
-        datasets = climatedb.fetch_datasets(data_source_id, start_date, end_date, calibrated)
+        datasets = [
+            dataset
+            for dataset in climatedb.fetch_datasets(data_source_id, start_date, end_date, calibrated)
+            if dataset['measurement_id'] == measurement_id
+        ]
+
+        lats = np.fromiter((geoname['latitude'] for geoname in geonames), dtype=np.float64, count=len(geonames))
+        lons = np.fromiter((geoname['longitude'] for geoname in geonames), dtype=np.float64, count=len(geonames))
 
         for dataset in datasets:
-            if measurement_id == dataset['measurement_id']:
-                units = climatedb.fetch_unit_by_id(dataset['unit_id'])['code']
+            units = climatedb.fetch_unit_by_id(dataset['unit_id'])['code']
 
-                for geoname in geonames:
-                    lat = geoname['latitude']
-                    lon = geoname['longitude']
+            normals_arr = fetch_normals_by_locations(dataset, lats, lons)
 
-                    try:
-                        actual_lat, actual_lon, normals_arr = fetch_normals_by_location(dataset, lat, lon, False)
-                        if not np.ma.is_masked(normals_arr[months]):
-                            mean = normals_arr[months].mean()
-                            geoname[measurement] = [mean, units]
+            # Presumably places missing data are in the ocean where there is no data.
+            has_data = ~np.ma.getmaskarray(normals_arr).any(axis=1)
+            means = normals_arr[:, months].mean(axis=1) / pack.SCALE_FACTOR
 
-                    except climatedb.NotFoundError:
-                        # Presumably the place is in the ocean where there is no data.
-                        pass
+            for geoname, mean, geoname_has_data in zip(geonames, means.tolist(), has_data):
+                if geoname_has_data:
+                    geoname[measurement] = [mean, units]
 
-        return jsonify(geonames)
+        return json_response(geonames)
 
     except climatedb.NotFoundError as e:
         return jsonify({'error': str(e)}), 404
 
-def fetch_normals_by_location(dataset, lat, lon, check_calibration=True):
+def json_response(data):
+    '''
+    Gives a JSON response with the specified data. This uses orjson
+    if it is installed, as it serializes large responses much faster
+    than jsonify(). Like jsonify(), integer keys become strings.
+    '''
+    if orjson is None:
+        return jsonify(data)
+    else:
+        return Response(
+            orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY),
+            mimetype='application/json'
+        )
+
+def fetch_normals_by_location(dataset, lat, lon, check_calibration=config.api.check_calibration, calibration_datasets=None):
     '''
     Gives climate normals calibrated against a baseline dataset for a
     specific latitude and longitude.  If the dataset is not calibrated,
     we fetch the normals without calibrating.
+
+    If check_calibration is set, the normals are checked against the
+    calibrated dataset's data file. Otherwise that file is not read.
+
+    The calibration datasets can be passed in if they were already fetched
+    using calibration.fetch_calibration_datasets().
     '''
     calibrated = dataset['calibrated']
 
@@ -215,9 +322,13 @@ def fetch_normals_by_location(dataset, lat, lon, check_calibration=True):
         calibrated_lat, calibrated_lon, calibrated_normals_arr = calibration.calibrate_location(
             dataset,
             lat,
-            lon
+            lon,
+            calibration_datasets
         )
 
+        if not check_calibration:
+            return calibrated_lat, calibrated_lon, calibrated_normals_arr / pack.SCALE_FACTOR
+
     try:
         actual_lat, actual_lon, normals_arr = climatedb.fetch_monthly_normals(dataset, lat, lon)
 
@@ -231,7 +342,7 @@ def fetch_normals_by_location(dataset, lat, lon, check_calibration=True):
         if (actual_lat, actual_lon) != (calibrated_lat, calibrated_lon):
             raise Exception('Expected calibrated coordinates to match those from on-the-fly calibration')
 
-        if check_calibration and np.any(normals_arr != calibrated_normals_arr):
+        if not np.ma.allequal(normals_arr, calibrated_normals_arr):
             raise Exception('Expected calibrated normals to correspond with on-the-fly calibration')
 
         return calibrated_lat, calibrated_lon, calibrated_normals_arr / pack.SCALE_FACTOR
@@ -239,6 +350,23 @@ def fetch_normals_by_location(dataset, lat, lon, check_calibration=True):
     else:
         return actual_lat, actual_lon, normals_arr / pack.SCALE_FACTOR
 
+def fetch_normals_by_locations(dataset, lats, lons):
+    '''
+    Gives climate normals for each of the specified latitudes and longitudes,
+    calibrated if the dataset is calibrated, as in fetch_normals_by_location().
+
+    Gives a masked array with the normals of each location in a row.
+    Locations without data are masked. Unlike fetch_normals_by_location(),
+    the normals are not divided by the scale factor yet, so that only the
+    aggregated values have to be.
+    '''
+    if dataset['calibrated']:
+        actual_lats, actual_lons, normals_arr = calibration.calibrate_locations(dataset, lats, lons)
+    else:
+        actual_lats, actual_lons, normals_arr = climatedb.fetch_monthly_normals_batch(dataset, lats, lons)
+
+    return normals_arr
+
 def fetch_nontemporal_value(measurement_code, lat, lon):
     '''
     Fetches the elevation of the specified latitude and longitude
@@ -259,4 +387,5 @@ def fetch_nontemporal_value(measurement_code, lat, lon):
     return value, unit['code'], data_source['code']
 
 if __name__ == '__main__':
+    # Development server only, see the README for running it under uWSGI.
     app.run(processes=3)
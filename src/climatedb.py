@@ -6,11 +6,10 @@
 #
 
 import MySQLdb
-import re
-import math
-from datetime import datetime
+import functools
+from contextlib import contextmanager
+import mmap
 from datetime import date
-import time
 import os.path
 import numpy as np
 
@@ -26,12 +25,29 @@ DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
 DATA_DTYPE = pack.OUTPUT_DTYPE # Data type of climate normal values stored in the database, helps save space
 LAT_DTYPE = LON_DTYPE = np.float64
 FETCH_DTYPE = np.float64 # Data type returned from db, important for preventing integer overflow
+GRID_FETCH_DTYPE = np.float32 # Data type of whole grids returned from db, exact for any int16 value
 NONTEMPORAL_DTYPE = np.float64
 
 MONTHS_PER_YEAR = 12
 
 CHARSET = 'utf8mb4'
 
+# Units, measurements, and data sources rarely change, and datasets are never
+# updated once created, so lookups of them are cached for the life of the process.
+METADATA_CACHE_SIZE = 256
+
+# Number of memmaps kept open for point queries. Each dataset has a data,
+# latitude, and longitude file, and a calibrated /monthly-normals request
+# maps the calibrated, projection, historical, and baseline datasets of
+# all 6 measurements plus elevation: 75 files with the calibration check
+# on, 57 without. The files are visited in the same order every request,
+# so an LRU cache smaller than the working set of a few data sources
+# would evict every file before it is reused. The data itself is cached
+# by the OS in the page cache, but each memmap keeps a duplicate of its
+# file descriptor open, so every API process may hold this many descriptors.
+# That is a quarter of the usual soft limit of 1024, see the README.
+MEMMAP_CACHE_SIZE = 256
+
 def connect():
     '''
     Connects to the specified db
@@ -45,6 +61,23 @@ def connect():
         password=config.database.password
     )
 
+    invalidate_caches()
+
+def ensure_connected():
+    '''
+    Connects to the db unless already connected, so that the connection
+    can be reused. Reconnects if the connection was lost, e.g. because
+    it was idle for longer than the server's wait_timeout.
+    '''
+    if db is not None:
+        try:
+            db.conn.ping()
+            return
+        except MySQLdb.OperationalError:
+            pass
+
+    connect()
+
 def rollback():
     '''
     Rolls the transaction back.
@@ -57,6 +90,23 @@ def commit():
     '''
     db.conn.commit()
 
+@contextmanager
+def transaction():
+    '''
+    Runs the statements in the with block in a single transaction,
+    which is committed at the end of the block, or rolled back if
+    an exception is raised.
+
+    Autocommit is off, so this lets loaders insert many rows and
+    only pay for one commit.
+    '''
+    try:
+        yield
+        commit()
+    except BaseException:
+        rollback()
+        raise
+
 def close():
     '''
     Closes the database
@@ -64,6 +114,21 @@ def close():
     db.cur.close()
     db.conn.close()
 
+def invalidate_caches():
+    '''
+    Clears the cached units, measurements, data sources, and datasets,
+    so that they are fetched from the database again.
+    '''
+    fetch_unit_by_id.cache_clear()
+    fetch_unit.cache_clear()
+    fetch_measurement_by_id.cache_clear()
+    fetch_measurement.cache_clear()
+    fetch_data_source_by_id.cache_clear()
+    fetch_data_source.cache_clear()
+    fetch_baseline_data_source.cache_clear()
+    fetch_historical_data_source.cache_clear()
+    fetch_dataset.cache_clear()
+
 class Db:
     '''
     Represents a database
@@ -83,6 +148,7 @@ class NotFoundError(Exception):
     '''
     pass
 
+@functools.lru_cache(maxsize=METADATA_CACHE_SIZE)
 def fetch_unit_by_id(unit_id):
     '''
     Fetches the specified unit by ID
@@ -101,6 +167,7 @@ def fetch_unit_by_id(unit_id):
         'name': unit_name,
     }
 
+@functools.lru_cache(maxsize=METADATA_CACHE_SIZE)
 def fetch_unit(units):
     '''
     Fetches the specified unit record using the specified units code (e.g. 'degC', 'mm').
@@ -132,6 +199,7 @@ def fetch_measurements():
 
     return [measurement_code for measurement_code, in rows]
 
+@functools.lru_cache(maxsize=METADATA_CACHE_SIZE)
 def fetch_measurement_by_id(measurement_id):
     '''
     Fetches the specified measurement
@@ -150,6 +218,7 @@ def fetch_measurement_by_id(measurement_id):
         'name': measurement_name,
     }
 
+@functools.lru_cache(maxsize=METADATA_CACHE_SIZE)
 def fetch_measurement(measurement):
     '''
     Fetches the specified measurement
@@ -186,6 +255,8 @@ def create_data_source(code, name, organisation, author, year, url, baseline):
         (code, name, organisation, author, year, url, baseline)
     )
 
+    invalidate_caches()
+
 def update_data_source(code, name, organisation, author, year, url, baseline):
     '''
     Updates the specified data source.
@@ -204,6 +275,9 @@ def update_data_source(code, name, organisation, author, year, url, baseline):
         (name, organisation, author, year, url, baseline, code)
     )
 
+    invalidate_caches()
+
+@functools.lru_cache(maxsize=METADATA_CACHE_SIZE)
 def fetch_data_source_by_id(data_source_id):
     '''
     Fetches the specified data source
@@ -236,6 +310,7 @@ def fetch_data_source_by_id(data_source_id):
         'active': active,
     }
 
+@functools.lru_cache(maxsize=METADATA_CACHE_SIZE)
 def fetch_data_source(data_source_code):
     '''
     Fetches the specified data source
@@ -268,6 +343,7 @@ def fetch_data_source(data_source_code):
         'active': active,
     }
 
+@functools.lru_cache(maxsize=1)
 def fetch_baseline_data_source():
     '''
     Fetches the baseline data source
@@ -292,6 +368,7 @@ def fetch_baseline_data_source():
 
     return data_source_id
 
+@functools.lru_cache(maxsize=METADATA_CACHE_SIZE)
 def fetch_historical_data_source(data_source_id):
     '''
     Fetches the historical data source for the specified
@@ -338,7 +415,7 @@ def fetch_date_ranges_by_data_source_id(data_source_id):
     if not rows:
         raise NotFoundError('Could not find date range for data source %d' % data_source_id)
 
-    return ((start_date, end_date) for start_date, end_date in rows)
+    return [(start_date, end_date) for start_date, end_date in rows]
 
 def update_max_zoom_level(data_source_id, max_zoom_level):
     '''
@@ -353,6 +430,8 @@ def update_max_zoom_level(data_source_id, max_zoom_level):
         (max_zoom_level, data_source_id)
     )
 
+    invalidate_caches()
+
 def fetch_date_ranges():
     '''
     Fetches all date ranges for available datasets in the system.
@@ -371,7 +450,7 @@ def fetch_date_ranges():
 
     rows = db.cur.fetchall()
 
-    return ('%d-%d' % (start_year, end_year) for start_year, end_year in rows)
+    return ['%d-%d' % (start_year, end_year) for start_year, end_year in rows]
 
 def fetch_datasets_by_date_range(start_date, end_date):
     '''
@@ -386,7 +465,7 @@ def fetch_datasets_by_date_range(start_date, end_date):
     )
     rows = db.cur.fetchall()
 
-    return (
+    return [
         {
             'id': dataset_id,
             'data_source_id': data_source_id,
@@ -394,8 +473,9 @@ def fetch_datasets_by_date_range(start_date, end_date):
             'calibrated': calibrated,
         }
         for dataset_id, data_source_id, measurement_id, calibrated in rows
-    )
+    ]
 
+@functools.lru_cache(maxsize=METADATA_CACHE_SIZE)
 def fetch_dataset(data_source_id, measurement_id, unit_id, start_date, end_date, calibrated):
     '''
     Fetches the specified dataset.
@@ -495,7 +575,7 @@ def fetch_datasets(data_source_id, start_date, end_date, calibrated):
             data_source_id, start_date, end_date
         ))
 
-    return (
+    return [
         {
             'id': dataset_id,
             'data_source_id': data_source_id,
@@ -528,7 +608,7 @@ def fetch_datasets(data_source_id, start_date, end_date, calibrated):
             calibrated,
         )
         in rows
-    )
+    ]
 
 def create_dataset(
         data_source_id,
@@ -548,6 +628,8 @@ def create_dataset(
 ):
     '''
     Creates a new dataset for the specified data source, start date, and end date.
+    Gives the new dataset record, with the values as they were given rather than
+    as stored, e.g. coordinates are stored with 10 decimal places.
     '''
     db.cur.execute(
         '''
@@ -587,7 +669,23 @@ def create_dataset(
         )
     )
 
-    return fetch_dataset(data_source_id, measurement_id, unit_id, start_date, end_date, calibrated)
+    return {
+        'id': db.cur.lastrowid,
+        'data_source_id': data_source_id,
+        'measurement_id': measurement_id,
+        'unit_id': unit_id,
+        'start_date': start_date,
+        'end_date': end_date,
+        'lat_start': lat_start,
+        'lat_delta': lat_delta,
+        'lon_start': lon_start,
+        'lon_delta': lon_delta,
+        'fill_value': fill_value,
+        'data_filename': data_filename,
+        'lat_filename': lat_filename,
+        'lon_filename': lon_filename,
+        'calibrated': calibrated,
+    }
 
 def fetch_dataset_by_measurement_id(data_source_id, measurement_id, unit_id):
     '''
@@ -605,12 +703,38 @@ def create_coord_memmap(coord_pathname, coord_arr):
     '''
     if os.path.exists(coord_pathname):
         coord_mmap = np.memmap(coord_pathname, dtype=coord_arr.dtype, mode='r')
-        if np.any(coord_mmap[:] != coord_arr):
+        if not np.array_equal(coord_mmap, coord_arr):
             raise Exception('Expected coordinate array to be the same in %s' % os.path.basename(coord_pathname))
     else:
         coord_mmap = np.memmap(coord_pathname, dtype=coord_arr.dtype, mode='w+', shape=coord_arr.shape)
         coord_mmap[:] = coord_arr
 
+@functools.lru_cache(maxsize=MEMMAP_CACHE_SIZE)
+def fetch_memmap(filename, dtype, shape=None):
+    '''
+    Fetches a read-only memmap of the specified file in the data folder.
+    Memmaps are kept open, so that point queries do not have to open and
+    map the same files over and over again. They are closed when data files
+    are written. Each one holds a file descriptor while it is open.
+
+    Point queries read a few scattered cells, so we tell the OS not to
+    read ahead, which would only fill the page cache with unused data.
+    '''
+    with open(os.path.join(DATA_DIR, filename), 'rb') as f:
+        data_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if hasattr(mmap, 'MADV_RANDOM'):
+        data_mmap.madvise(mmap.MADV_RANDOM)
+
+    if shape is not None:
+        # Data files may be larger than the data. As with np.memmap,
+        # only the part covered by the shape is used.
+        data_arr = np.frombuffer(data_mmap, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    else:
+        data_arr = np.frombuffer(data_mmap, dtype=dtype)
+
+    return data_arr
+
 def fetch_lat_memmap(dataset_record, lat):
     '''
     Fetches both the memmap with all latitudes and the index of the specified
@@ -619,8 +743,7 @@ def fetch_lat_memmap(dataset_record, lat):
     E.g. if latitude 43.3 is passed in, you may get index 47 corresponding to
     latitude 43.
     '''
-    lat_pathname = os.path.join(DATA_DIR, dataset_record['lat_filename'])
-    lat_mmap = np.memmap(lat_pathname, dtype=LAT_DTYPE, mode='r')
+    lat_mmap = fetch_memmap(dataset_record['lat_filename'], LAT_DTYPE)
 
     lat_i = arrays.find_lat_index(lat_mmap, dataset_record['lat_delta'], lat)
     actual_lat = lat_mmap[lat_i]
@@ -639,8 +762,7 @@ def fetch_lon_memmap(dataset_record, lon):
     E.g. if longitude 20.6 is passed in, you may get index 41 corresponding to
     longitude 20.5.
     '''
-    lon_pathname = os.path.join(DATA_DIR, dataset_record['lon_filename'])
-    lon_mmap = np.memmap(lon_pathname, dtype=LON_DTYPE, mode='r')
+    lon_mmap = fetch_memmap(dataset_record['lon_filename'], LON_DTYPE)
 
     lon_i = arrays.find_lon_index(lon_mmap, dataset_record['lon_delta'], lon)
     actual_lon = lon_mmap[lon_i]
@@ -700,15 +822,30 @@ def create_monthly_normals(
     lat_pathname = os.path.join(DATA_DIR, lat_basename)
     lon_pathname = os.path.join(DATA_DIR, lon_basename)
 
+    # The month is written straight to its place in the file. Writing it through
+    # a memmap would first read the pages being overwritten from disk.
+    data_size = MONTHS_PER_YEAR * data_arr.nbytes
+
     if os.path.exists(data_pathname):
-        data_mmap = np.memmap(data_pathname, dtype=data_arr.dtype, mode='r+', shape=(MONTHS_PER_YEAR,) + data_arr.shape)
+        if os.path.getsize(data_pathname) < data_size:
+            raise Exception('Expected %s to have at least %d bytes' % (data_basename, data_size))
+
+        data_file = open(data_pathname, 'r+b')
     else:
-        # Bug? 'w+' replaces all contents of the array with 0
-        data_mmap = np.memmap(data_pathname, dtype=data_arr.dtype, mode='w+', shape=(MONTHS_PER_YEAR,) + data_arr.shape)
+        data_file = open(data_pathname, 'w+b')
 
-    data_mmap[month - 1, :] = data_arr
+        # Allocate the whole file up front, so that the months written by
+        # separate runs are not scattered across the disk.
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(data_file.fileno(), 0, data_size)
+        else:
+            data_file.truncate(data_size)
 
-    del data_mmap
+    with data_file:
+        data_file.seek((month - 1) * data_arr.nbytes)
+        data_file.write(np.ascontiguousarray(np.ma.getdata(data_arr)))
+
+    fetch_memmap.cache_clear()
 
     create_coord_memmap(lat_pathname, lat_arr)
     create_coord_memmap(lon_pathname, lon_arr)
@@ -722,38 +859,56 @@ def fetch_monthly_normals(dataset_record, lat, lon):
     lat_i, actual_lat, lat_mmap = fetch_lat_memmap(dataset_record, lat)
     lon_i, actual_lon, lon_mmap = fetch_lon_memmap(dataset_record, lon)
 
-    data_pathname = os.path.join(DATA_DIR, dataset_record['data_filename'])
-    data_mmap = np.memmap(data_pathname, dtype=DATA_DTYPE, mode='r',
-                          shape=(MONTHS_PER_YEAR, lat_mmap.size, lon_mmap.size))
+    data_mmap = fetch_memmap(dataset_record['data_filename'], DATA_DTYPE,
+                             (MONTHS_PER_YEAR, lat_mmap.size, lon_mmap.size))
 
-    normals_arr = np.ma.masked_values(data_mmap[:, lat_i, lon_i], dataset_record['fill_value'])
+    normals_arr = data_mmap[:, lat_i, lon_i]
 
-    if np.ma.is_masked(normals_arr):
+    if np.any(normals_arr == dataset_record['fill_value']):
         raise NotFoundError('Some months missing data at %g, %g' % (actual_lat, actual_lon))
 
     return actual_lat, actual_lon, normals_arr.astype(FETCH_DTYPE)
 
+def fetch_monthly_normals_batch(dataset_record, lats, lons):
+    '''
+    Fetches the monthly normals for each of the specified locations.
+    The latitudes and longitudes are numpy arrays.
+
+    Gives the actual latitudes and longitudes, and a masked array
+    with the normals of each location in a row. Months without data
+    are masked, as are locations out of the range of the dataset.
+    The normals are left in the data type of the data file.
+    '''
+    lat_mmap = fetch_memmap(dataset_record['lat_filename'], LAT_DTYPE)
+    lon_mmap = fetch_memmap(dataset_record['lon_filename'], LON_DTYPE)
+
+    lat_i, lat_in_range = arrays.find_lat_indices(lat_mmap, dataset_record['lat_delta'], lats)
+    lon_i, lon_in_range = arrays.find_lon_indices(lon_mmap, dataset_record['lon_delta'], lons)
+
+    data_mmap = fetch_memmap(dataset_record['data_filename'], DATA_DTYPE,
+                             (MONTHS_PER_YEAR, lat_mmap.size, lon_mmap.size))
+
+    normals_arr = np.ma.masked_values(data_mmap[:, lat_i, lon_i].T, dataset_record['fill_value'])
+    normals_arr[~(lat_in_range & lon_in_range)] = np.ma.masked
+
+    return np.asarray(lat_mmap[lat_i]), np.asarray(lon_mmap[lon_i]), normals_arr
+
 def fetch_normals_from_dataset(dataset_record, month):
     '''
     Fetches the data from the specified dataset record.
     Gives the data for the specified  month, returning a 2-D array indexed by latitude and longitude.
     '''
     data_pathname = os.path.join(DATA_DIR, dataset_record['data_filename'])
-    lat_pathname = os.path.join(DATA_DIR, dataset_record['lat_filename'])
-    lon_pathname = os.path.join(DATA_DIR, dataset_record['lon_filename'])
 
-    lat_mmap = np.memmap(lat_pathname, dtype=LAT_DTYPE, mode='r')
-    lon_mmap = np.memmap(lon_pathname, dtype=LON_DTYPE, mode='r')
+    lat_mmap = fetch_memmap(dataset_record['lat_filename'], LAT_DTYPE)
+    lon_mmap = fetch_memmap(dataset_record['lon_filename'], LON_DTYPE)
 
     data_mmap = np.memmap(data_pathname, dtype=DATA_DTYPE, mode='r',
                           shape=(MONTHS_PER_YEAR, lat_mmap.size, lon_mmap.size))
 
-    if np.any(data_mmap == dataset_record['fill_value']):
-        data = np.ma.masked_values(data_mmap[month - 1, :], dataset_record['fill_value'])
-    else:
-        data = data_mmap[month - 1, :]
+    data = np.ma.masked_equal(data_mmap[month - 1, :], dataset_record['fill_value'], copy=False)
 
-    return lat_mmap, lon_mmap, data.astype(FETCH_DTYPE)
+    return lat_mmap, lon_mmap, data.astype(GRID_FETCH_DTYPE)
 
 def fetch_normals_from_dataset_mean(dataset_record):
     '''
@@ -762,23 +917,20 @@ def fetch_normals_from_dataset_mean(dataset_record):
     with the means for the entire year.
     '''
     data_pathname = os.path.join(DATA_DIR, dataset_record['data_filename'])
-    lat_pathname = os.path.join(DATA_DIR, dataset_record['lat_filename'])
-    lon_pathname = os.path.join(DATA_DIR, dataset_record['lon_filename'])
 
-    lat_mmap = np.memmap(lat_pathname, dtype=LAT_DTYPE, mode='r')
-    lon_mmap = np.memmap(lon_pathname, dtype=LON_DTYPE, mode='r')
+    lat_mmap = fetch_memmap(dataset_record['lat_filename'], LAT_DTYPE)
+    lon_mmap = fetch_memmap(dataset_record['lon_filename'], LON_DTYPE)
 
     data_mmap = np.memmap(data_pathname, dtype=DATA_DTYPE, mode='r',
                           shape=(MONTHS_PER_YEAR, lat_mmap.size, lon_mmap.size))
 
-    data_mean = np.round(data_mmap.mean(axis = 0)).astype(DATA_DTYPE)
+    # Sums of 12 int16 values are exact in float32, and so are their rounded means.
+    data_mean = data_mmap.mean(axis=0, dtype=GRID_FETCH_DTYPE)
+    data_mean = np.round(data_mean, out=data_mean).astype(DATA_DTYPE)
 
-    if np.any(data_mmap == dataset_record['fill_value']):
-        data = np.ma.masked_values(data_mean, dataset_record['fill_value'])
-    else:
-        data = data_mean
+    data = np.ma.masked_equal(data_mean, dataset_record['fill_value'], copy=False)
 
-    return lat_mmap, lon_mmap, data.astype(FETCH_DTYPE)
+    return lat_mmap, lon_mmap, data.astype(GRID_FETCH_DTYPE)
 
 def save_normals(
         lat_arr,
@@ -1038,6 +1190,8 @@ def create_nontemporal_data(data_source, measurement, units, lat_arr, lon_arr, d
 
     del data_mmap
 
+    fetch_memmap.cache_clear()
+
     create_coord_memmap(lat_pathname, lat_arr)
     create_coord_memmap(lon_pathname, lon_arr)
 
@@ -1056,8 +1210,7 @@ def fetch_nontemporal_value(dataset_record, lat, lon):
     lat_i, actual_lat, lat_mmap = fetch_lat_memmap(dataset_record, lat)
     lon_i, actual_lon, lon_mmap = fetch_lon_memmap(dataset_record, lon)
 
-    data_pathname = os.path.join(DATA_DIR, dataset_record['data_filename'])
-    data_mmap = np.memmap(data_pathname, dtype=NONTEMPORAL_DTYPE, mode='r', shape=(lat_mmap.size, lon_mmap.size))
+    data_mmap = fetch_memmap(dataset_record['data_filename'], NONTEMPORAL_DTYPE, (lat_mmap.size, lon_mmap.size))
 
     value = data_mmap[lat_i, lon_i]
 
@@ -42,4 +42,7 @@ images.watermark = _Object()
 images.watermark.filename = _yaml_data['images']['watermark']['filename']
 images.watermark.opacity = _yaml_data['images']['watermark']['opacity']
 
+api = _Object()
+api.check_calibration = (_yaml_data.get('api') or {}).get('check_calibration', False)
+
 del _yaml_data
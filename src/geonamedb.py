@@ -111,6 +111,33 @@ def create_geoname(geonameid, name, lat, lon, feature_class, feature_code, count
         (geonameid, name, lon, lat, feature_class, feature_code, country, province, population, elevation)
     )
 
+def create_geonames(geonames):
+    '''
+    Creates the specified geoname entries in a single INSERT.
+    Each geoname is a tuple of the arguments of create_geoname().
+    '''
+    climatedb.db.cur.execute(
+        '''
+        INSERT INTO geonames(
+            geonameid,
+            name,
+            location,
+            feature_class,
+            feature_code,
+            country,
+            province,
+            population,
+            elevation)
+        VALUES
+        '''
+        + ', '.join(['(%s, %s, POINT(%s, %s), %s, %s, %s, %s, %s, %s)'] * len(geonames)),
+        tuple(
+            value
+            for geonameid, name, lat, lon, feature_class, feature_code, country, province, population, elevation in geonames
+            for value in (geonameid, name, lon, lat, feature_class, feature_code, country, province, population, elevation)
+        )
+    )
+
 def fetch_geoname(name, province=None, country=None):
     '''
     Fetches the most populous geoname with the specified name.
@@ -310,6 +337,15 @@ def create_province(code, name, country, geonameid):
         (code, name, country, geonameid)
     )
 
+def fetch_province_codes():
+    '''
+    Fetches the set of all province codes, upper case, since
+    they are compared case-insensitively in the database.
+    '''
+    climatedb.db.cur.execute('SELECT DISTINCT province_code FROM provinces')
+
+    return {province_code.upper() for province_code, in climatedb.db.cur.fetchall()}
+
 def fetch_geoname_by_province(province_code, country):
     '''
     Fetches the geoname of the specified province.
@@ -12,13 +12,22 @@ import MySQLdb.constants.ER
 import climatedb
 import geonamedb
 
+# Number of geonames inserted per INSERT statement
+GEONAMES_BATCH_SIZE = 1000
+
 def load_geonames(filename):
     '''
     Loads the geonames from the specified file.
     See https://download.geonames.org/export/dump/ for export and documentation.
     '''
-    with open(filename, encoding='utf-8') as f:
+    with open(filename, encoding='utf-8') as f, climatedb.transaction():
         geonamedb.delete_geonames()
+        geonames = []
+
+        # Geonames whose province is unknown are saved without a province.
+        # Checking this here keeps them from failing a whole batch.
+        province_codes = geonamedb.fetch_province_codes()
+
         for line in f:
             row = line[:-1].split('\t')
             (
@@ -43,68 +52,106 @@ def load_geonames(filename):
                 modification_date,
             ) = row
 
-            province = None if admin1_code == '' else admin1_code
+            province = admin1_code if admin1_code.upper() in province_codes else None
             country = None if country == '' else country
             population = None if population == '' else int(population)
             elevation = None if elevation == '' else int(elevation)
 
-            try:
-                geonamedb.create_geoname(
-                    geonameid,
-                    name,
-                    latitude,
-                    longitude,
-                    feature_class,
-                    feature_code,
-                    country,
-                    province,
-                    population,
-                    elevation
-                )
+            geonames.append((
+                geonameid,
+                name,
+                latitude,
+                longitude,
+                feature_class,
+                feature_code,
+                country,
+                province,
+                population,
+                elevation
+            ))
 
-            except IntegrityError as e:
-                if e.args[0] == MySQLdb.constants.ER.NO_REFERENCED_ROW_2 \
-                and e.args[1].find('FOREIGN KEY (`province`)') != -1:
-                    geonamedb.create_geoname(
-                        geonameid,
-                        name,
-                        latitude,
-                        longitude,
-                        feature_class,
-                        feature_code,
-                        country,
-                        None,
-                        population,
-                        elevation
-                    )
-                else:
-                    raise e
+            if len(geonames) == GEONAMES_BATCH_SIZE:
+                save_geonames(geonames)
+                geonames = []
 
-            except DataError as e:
-                if e.args[0] == MySQLdb.constants.ER.DATA_TOO_LONG \
-                and e.args[1] == 'Data too long for column \'province\' at row 1':
-                    geonamedb.create_geoname(
-                        geonameid,
-                        name,
-                        latitude,
-                        longitude,
-                        feature_class,
-                        feature_code,
-                        country,
-                        None,
-                        population,
-                        elevation
-                    )
-                else:
-                    raise e
+        save_geonames(geonames)
+
+def save_geonames(geonames):
+    '''
+    Saves the specified geonames in a single INSERT. Unknown provinces
+    are already removed by load_geonames(), but if any of the geonames
+    still cannot be saved as is, we save them one at a time instead.
+    '''
+    if not geonames:
+        return
+
+    try:
+        geonamedb.create_geonames(geonames)
 
-    climatedb.commit()
+    except (IntegrityError, DataError):
+        for geoname in geonames:
+            save_geoname(*geoname)
+
+def save_geoname(geonameid, name, latitude, longitude, feature_class, feature_code, country, province, population, elevation):
+    '''
+    Saves the specified geoname. If its province is unknown
+    or invalid, we save it without a province.
+    '''
+    try:
+        geonamedb.create_geoname(
+            geonameid,
+            name,
+            latitude,
+            longitude,
+            feature_class,
+            feature_code,
+            country,
+            province,
+            population,
+            elevation
+        )
+
+    except IntegrityError as e:
+        if e.args[0] == MySQLdb.constants.ER.NO_REFERENCED_ROW_2 \
+        and e.args[1].find('FOREIGN KEY (`province`)') != -1:
+            geonamedb.create_geoname(
+                geonameid,
+                name,
+                latitude,
+                longitude,
+                feature_class,
+                feature_code,
+                country,
+                None,
+                population,
+                elevation
+            )
+        else:
+            raise e
+
+    except DataError as e:
+        if e.args[0] == MySQLdb.constants.ER.DATA_TOO_LONG \
+        and e.args[1] == 'Data too long for column \'province\' at row 1':
+            geonamedb.create_geoname(
+                geonameid,
+                name,
+                latitude,
+                longitude,
+                feature_class,
+                feature_code,
+                country,
+                None,
+                population,
+                elevation
+            )
+        else:
+            raise e
 
 def load_countries(filename):
     '''
     Loads country information from the specified file.
     '''
-    with open(filename, encoding='utf-8') as f:
+    with open(filename, encoding='utf-8') as f, climatedb.transaction():
         geonamedb.delete_countries()
         for line in f:
             if line[0] != '#':
@@ -133,13 +180,11 @@ def load_countries(filename):
 
                 geonamedb.create_country(iso, name, geonameid)
 
-        climatedb.commit()
-
 def load_provinces(filename):
     '''
     Loads province information from the specified file.
     '''
-    with open(filename, encoding='utf-8') as f:
+    with open(filename, encoding='utf-8') as f, climatedb.transaction():
         geonamedb.delete_provinces()
 
         for line in f:
@@ -155,13 +200,11 @@ def load_provinces(filename):
 
             geonamedb.create_province(province_code, utf8_name, country, geonameid)
 
-        climatedb.commit()
-
 def load_alternate_names(filename):
     '''
     Loads alternate name information from the specified file.
     '''
-    with open(filename, encoding='utf-8') as f:
+    with open(filename, encoding='utf-8') as f, climatedb.transaction():
         geonamedb.delete_alternate_names()
 
         for line in f:
@@ -198,5 +241,3 @@ def load_alternate_names(filename):
                         print('Geoname ID %d is not found' % int(geonameid))
                     else:
                         raise e
-
-        climatedb.commit()